@@ -399,13 +399,13 @@ class Kernel:
     def load_config(self, kdir: str) -> None:
         cfgfile = os.path.join(kdir, ".config")
         if os.path.isfile(cfgfile):
-            self.config = {}
-            regex = re.compile("^(CONFIG_[A-Z0-9_]+)=([ymn])$")
+            # Scan the whole file with a single multi-line regex, instead
+            # of matching each line in Python (a .config can easily have
+            # ~10k lines). Surrounding whitespace is ignored, like when
+            # each line was stripped.
+            regex = re.compile(r"^[^\S\n]*(CONFIG_[A-Z0-9_]+)=([ymn])[^\S\n]*$", re.MULTILINE)
             with open(cfgfile, "r", encoding="utf-8") as fd:
-                for line in fd:
-                    m = regex.match(line.strip())
-                    if m:
-                        self.config[m.group(1)] = m.group(2)
+                self.config = dict(regex.findall(fd.read()))
 
 
 def get_rootfs_from_kernel_path(path):
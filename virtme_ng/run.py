@@ -4,16 +4,21 @@
 """virtme-ng: main command-line frontend."""
 
 import argparse
+import contextlib
+import functools
 import re
 import os
 import platform
 import sys
 import socket
 import shutil
+import shlex
 import json
 import signal
+import selectors
 import tempfile
 from subprocess import (
+    call,
     check_call,
     check_output,
     Popen,
@@ -21,47 +26,91 @@ from subprocess import (
     PIPE,
     CalledProcessError,
 )
-from select import select
 from pathlib import Path
 
 import argcomplete
 
 from virtme.util import SilentError, get_username
 from virtme_ng.utils import CONF_FILE, spinner_decorator
-from virtme_ng.mainline import KernelDownloader
 from virtme_ng.version import VERSION
 
 
-def check_call_cmd(command, quiet=False, dry_run=False):
+def _write_output(stream, data):
+    if stream is not None and data:
+        stream.write(data.decode(errors="replace"))
+        stream.flush()
+
+
+def check_call_cmd(command, quiet=False, dry_run=False, env=None, stdin_data=None):
     if dry_run:
-        print(" ".join(command))
+        if stdin_data is None:
+            print(" ".join(command))
+        else:
+            print(" ".join(command) + " <<'EOF'\n" + stdin_data + "EOF")
         return
     with Popen(
         command,
         stdout=PIPE,
         stderr=PIPE,
-        stdin=DEVNULL,
+        stdin=DEVNULL if stdin_data is None else PIPE,
+        env=env,
     ) as process:
         process.stdout.flush()
         process.stderr.flush()
 
-        stdout_fd = process.stdout.fileno()
-        stderr_fd = process.stderr.fileno()
-
-        # Use select to poll for new data in the file descriptors
-        while process.poll() is None:
-            ready_to_read, _, _ = select([stdout_fd, stderr_fd], [], [], 1)
-            for file in ready_to_read:
-                if file == stdout_fd:
-                    line = process.stdout.readline().decode()
-                    if line and not quiet:
-                        sys.stdout.write(line)
-                        sys.stdout.flush()
-                if file == stderr_fd:
-                    line = process.stderr.readline().decode()
-                    if line:
-                        sys.stderr.write(line)
-                        sys.stderr.flush()
+        # Use a selector (epoll on Linux) to poll for new data in the file
+        # descriptors: the pipes are registered only once and each one is
+        # dropped as soon as it reaches EOF (or, for stdin, as soon as all the
+        # input has been written).
+        #
+        # Data is read in large raw chunks, but only complete lines are
+        # written to the output streams (a partial line is kept in pending
+        # until the rest of it arrives), so that the output doesn't get mixed
+        # with the spinner line.
+        pending = {}
+        with selectors.DefaultSelector() as sel:
+            sel.register(process.stdout, selectors.EVENT_READ, None if quiet else sys.stdout)
+            sel.register(process.stderr, selectors.EVENT_READ, sys.stderr)
+            if stdin_data is not None:
+                # Feed the input in non-blocking chunks from the same loop
+                # that drains the output, otherwise we could deadlock when
+                # both the input and the output pipes are full.
+                stdin_buf = memoryview(stdin_data.encode())
+                os.set_blocking(process.stdin.fileno(), False)
+                sel.register(process.stdin, selectors.EVENT_WRITE)
+            while sel.get_map():
+                ready = sel.select(timeout=1)
+                # Stop if the process is gone and nothing else is coming (the
+                # pipes may be kept open by some background child process).
+                if not ready and process.poll() is not None:
+                    break
+                for key, _ in ready:
+                    if key.fileobj is process.stdin:
+                        try:
+                            stdin_buf = stdin_buf[os.write(key.fd, stdin_buf[:PIPE_CHUNK_SIZE]):]
+                        except BlockingIOError:
+                            continue
+                        except BrokenPipeError:
+                            # The process stopped reading its input, the
+                            # return code will report any error
+                            stdin_buf = stdin_buf[:0]
+                        if not stdin_buf:
+                            sel.unregister(process.stdin)
+                            process.stdin.close()
+                        continue
+                    data = os.read(key.fd, PIPE_CHUNK_SIZE)
+                    if not data:
+                        sel.unregister(key.fileobj)
+                        _write_output(key.data, pending.pop(key.fd, b""))
+                        continue
+                    # Keep draining the pipe even if the output is discarded
+                    if key.data is None:
+                        continue
+                    lines, sep, pending[key.fd] = (pending.get(key.fd, b"") + data).rpartition(b"\n")
+                    _write_output(key.data, lines + sep)
+            # Flush any partial line left behind
+            for key in sel.get_map().values():
+                _write_output(key.data, pending.get(key.fd, b""))
 
         # Wait for the process to complete and get the return code
         return_code = process.wait()
@@ -540,14 +589,17 @@ virtme-ng is based on virtme, written by Andy Lutomirski <luto@kernel.org>.
     return parser
 
 
-_ARGPARSER = make_parser()
+@functools.lru_cache(maxsize=1)
+def _get_parser():
+    # Build the parser only on first use, not at import time
+    return make_parser()
 
 
 def arg_fail(message, show_usage=True):
     """Print an error message and exit, optionally showing usage help."""
     sys.stderr.write(message + "\n")
     if show_usage:
-        _ARGPARSER.print_usage()
+        _get_parser().print_usage()
     sys.exit(1)
 
 
@@ -590,13 +642,38 @@ ARCH_MAPPING = {
     },
 }
 
+# Map platform.machine() values to virtme-ng arch names
+HOST_ARCH_MAPPING = {
+    "x86_64": "amd64",
+    "aarch64": "arm64",
+    "armv7l": "armhf",
+    "ppc64le": "ppc64el",
+    "riscv64": "riscv64",
+    "s390x": "s390x",
+}
+
 MAKE_COMMAND = "make LOCALVERSION=-virtme"
 
+# Maximum amount of data read or written at once from/to the pipes of a child
+# process
+PIPE_CHUNK_SIZE = 64 * 1024
+
+# Directories providing ccache compiler wrappers (e.g., gcc -> ccache)
+CCACHE_DIRS = ("/usr/lib/ccache", "/usr/lib64/ccache")
+
+# NOTE: the script is passed to bash via stdin, so run everything inside a
+# group reading from /dev/null: this way bash parses the whole script before
+# running it and no command can consume the rest of the script from stdin.
 REMOTE_BUILD_SCRIPT = """#!/bin/bash
+{{
 cd ~/.virtme
+for d in /usr/lib/ccache /usr/lib64/ccache; do
+    [ -d $d ] && export PATH=$d:$PATH && break
+done
 git reset --hard __virtme__
 [ -f debian/rules ] && fakeroot debian/rules clean
 {} {}
+}} </dev/null
 """
 
 
@@ -608,39 +685,115 @@ def create_root(destdir, arch, release):
     # small and they provide a nice environment to test kernels.
     if release is None:
         try:
-            release = (
-                check_output("lsb_release -s -c", shell=True)
-                .decode(sys.stdout.encoding)
-                .rstrip()
-            )
+            release = check_output(["lsb_release", "-s", "-c"], text=True).rstrip()
             if release == "n/a":
                 raise ValueError("unknown release")
-        except (CalledProcessError, ValueError):
+        except (CalledProcessError, FileNotFoundError, ValueError):
             print("Unknown release, try specifying an Ubuntu release with --root-release")
             sys.exit(1)
     url = (
         "https://cloud-images.ubuntu.com/"
         + f"{release}/current/{release}-server-cloudimg-{arch}-root.tar.xz"
     )
-    prevdir = os.getcwd()
-    os.system(f"sudo mkdir -p {destdir}")
-    os.chdir(destdir)
-    os.system(f"curl -s {url} | sudo tar xvJ")
-    os.chdir(prevdir)
+    check_call(["sudo", "mkdir", "-p", destdir])
+    # Stream the image directly from curl to tar, using a parallel xz
+    # decompressor if available.
+    if shutil.which("pixz"):
+        tar_opts = ["-I", "pixz", "-xf", "-"]
+    elif shutil.which("xz"):
+        tar_opts = ["-I", "xz -T0", "-xf", "-"]
+    else:
+        tar_opts = ["-xJf", "-"]
+    curl_opts = ["-fSL", "--progress-bar"] if sys.stderr.isatty() else ["-fsSL"]
+    with Popen(["curl"] + curl_opts + [url], stdout=PIPE) as curl_p:
+        with Popen(["sudo", "tar"] + tar_opts, stdin=curl_p.stdout, cwd=destdir) as tar_p:
+            # Let curl receive SIGPIPE if tar exits early
+            curl_p.stdout.close()
+            tar_ret = tar_p.wait()
+        curl_ret = curl_p.wait()
+    if curl_ret or tar_ret:
+        sys.stderr.write(f"failed to download and extract {url}\n")
+        sys.exit(1)
+
+
+def get_build_env():
+    """Return the environment used to build the kernel.
+
+    If ccache is installed, its compiler wrappers are put in front of PATH,
+    so that rebuilding the same kernel can reuse previously compiled objects
+    (ccache can still be disabled by setting CCACHE_DISABLE=1).
+    """
+    env = os.environ.copy()
+    path = env.get("PATH", "")
+    # If PATH is unset or empty leave it alone, otherwise we would replace
+    # the default search path used to find the compiler and make.
+    if not path:
+        return env
+    for ccache_dir in CCACHE_DIRS:
+        if os.path.isdir(ccache_dir):
+            if ccache_dir not in path.split(os.pathsep):
+                env["PATH"] = f"{ccache_dir}{os.pathsep}{path}"
+            break
+    return env
 
 
 def get_host_arch():
     """Translate host architecture to the corresponding virtme-ng arch name."""
-    arch = platform.machine()
-    arch_map = {
-        'x86_64': 'amd64',
-        'aarch64': 'arm64',
-        'armv7l': 'armhf',
-        'ppc64le': 'ppc64el',
-        'riscv64': 'riscv64',
-        's390x': 's390x',
-    }
-    return arch_map.get(arch, None)
+    return HOST_ARCH_MAPPING.get(platform.machine(), None)
+
+
+@contextlib.contextmanager
+def ssh_control_master(host, dry_run=False):
+    """Share a single ssh connection to a remote host across multiple commands.
+
+    Yield the ssh options that make ssh (and the tools running on top of it,
+    like git and rsync) reuse a master connection, so that only the first
+    command pays for the connection setup and authentication.
+
+    Yield an empty list of options (no connection sharing) in dry-run mode, or
+    if the master connection can't be started.
+    """
+    if dry_run:
+        yield []
+        return
+    # Keep the control socket in a short directory (not in $TMPDIR), since
+    # Unix socket paths are limited to 104 bytes on macOS/BSD.
+    ctl_dir = tempfile.mkdtemp(prefix="vng-", dir="/tmp")
+    ctl_path = f"{ctl_dir}/cm-%C"
+    ret = call(
+        [
+            "ssh",
+            "-o", f"ControlPath={ctl_path}",
+            "-o", "ControlMaster=yes",
+            "-o", "ControlPersist=60s",
+            "-N", "-f", host,
+        ],
+        stdin=DEVNULL,
+        stdout=DEVNULL,
+        stderr=DEVNULL,
+    )
+    if ret != 0:
+        shutil.rmtree(ctl_dir, ignore_errors=True)
+        yield []
+        return
+    # Never let the other commands become a master themselves (e.g., if the
+    # master goes away), they would keep running in background.
+    ssh_opts = ["-o", f"ControlPath={ctl_path}", "-o", "ControlMaster=no"]
+    try:
+        yield ssh_opts
+    finally:
+        call(["ssh", *ssh_opts, "-O", "exit", host], stdout=DEVNULL, stderr=DEVNULL)
+        shutil.rmtree(ctl_dir, ignore_errors=True)
+
+
+def _git_ssh_configured():
+    """Return True if the user has a custom ssh command configured for git."""
+    if "GIT_SSH_COMMAND" in os.environ or "GIT_SSH" in os.environ:
+        return True
+    try:
+        return bool(check_output(["git", "config", "core.sshCommand"], stderr=DEVNULL, stdin=DEVNULL).strip())
+    except (CalledProcessError, FileNotFoundError):
+        return False
 
 
 class KernelSource:
@@ -655,7 +808,12 @@ class KernelSource:
                 conf_data = json.loads(conf_fd.read())
                 if "default_opts" in conf_data:
                     self.default_opts = conf_data["default_opts"]
-        self.cpus = str(os.cpu_count())
+        # Like nproc(1), only count the CPUs that we are allowed to run on
+        # (e.g., when vng is started with taskset or inside a cpuset).
+        if hasattr(os, "sched_getaffinity"):
+            self.cpus = str(len(os.sched_getaffinity(0)))
+        else:
+            self.cpus = str(os.cpu_count())
 
     def get_conf_file_path(self):
         """Return virtme-ng main configuration file path."""
@@ -678,6 +836,14 @@ class KernelSource:
         return list(filter(None, cmd.split(" ")))
 
     def _is_dirty_repo(self):
+        # git diff stops at the first modified file (untracked files are
+        # ignored, like status -uno): it returns 0 if the tree is clean, 1
+        # if it's dirty, anything else means failure (e.g., there is no
+        # HEAD yet), in this case fall back to git status.
+        cmd = "git --no-optional-locks diff --quiet HEAD --"
+        ret = call(self._format_cmd(cmd), stdout=DEVNULL, stderr=DEVNULL, stdin=DEVNULL)
+        if ret in (0, 1):
+            return ret == 1
         cmd = "git --no-optional-locks status -uno --porcelain"
         if check_output(self._format_cmd(cmd), stderr=DEVNULL, stdin=DEVNULL):
             return True
@@ -733,66 +899,72 @@ class KernelSource:
         )
 
     def _make_remote(self, args, make_command):
-        check_call_cmd(
-            ["ssh", args.build_host, "mkdir -p ~/.virtme"],
-            quiet=not args.verbose,
-            dry_run=args.dry_run,
-        )
-        check_call_cmd(
-            ["ssh", args.build_host, "git init ~/.virtme"],
-            quiet=not args.verbose,
-            dry_run=args.dry_run,
-        )
-        check_call_cmd(
-            [
-                "git",
-                "push",
-                "--force",
-                "--porcelain",
-                f"{args.build_host}:~/.virtme",
-                "HEAD:refs/heads/__virtme__",
-            ],
-            quiet=not args.verbose,
-            dry_run=args.dry_run,
-        )
-        cmd = f"rsync .config {args.build_host}:.virtme/.config"
-        check_call_cmd(
-            self._format_cmd(cmd), quiet=not args.verbose, dry_run=args.dry_run
-        )
-        # Create remote build script
-        with tempfile.NamedTemporaryFile(mode="w+t") as tmp:
-            tmp.write(
-                REMOTE_BUILD_SCRIPT.format(
-                    args.build_host_exec_prefix or "",
-                    make_command + " -j$(nproc --all)",
-                )
+        with ssh_control_master(args.build_host, args.dry_run) as ssh_opts:
+            # Share the ssh connection also with git and rsync, unless the
+            # user configured a custom ssh command for them
+            ssh_cmd = shlex.join(["ssh", *ssh_opts])
+            env = os.environ.copy()
+            if ssh_opts and not _git_ssh_configured():
+                env["GIT_SSH_COMMAND"] = ssh_cmd
+            if ssh_opts and "RSYNC_RSH" not in os.environ:
+                rsync_rsh = ["-e", ssh_cmd]
+            else:
+                rsync_rsh = []
+            # Prepare the remote repository with a single round trip
+            check_call_cmd(
+                ["ssh", *ssh_opts, args.build_host, "mkdir -p ~/.virtme && git init -q ~/.virtme"],
+                quiet=not args.verbose,
+                dry_run=args.dry_run,
             )
-            tmp.flush()
-            cmd = f"rsync {tmp.name} {args.build_host}:.virtme/.kc-build"
             check_call_cmd(
-                self._format_cmd(cmd), quiet=not args.verbose, dry_run=args.dry_run
+                [
+                    "git",
+                    "push",
+                    "--force",
+                    "--porcelain",
+                    f"{args.build_host}:~/.virtme",
+                    "HEAD:refs/heads/__virtme__",
+                ],
+                quiet=not args.verbose,
+                dry_run=args.dry_run,
+                env=env,
             )
-        # Execute remote build script
-        check_call_cmd(
-            ["ssh", args.build_host, "bash", ".virtme/.kc-build"],
-            quiet=not args.verbose,
-            dry_run=args.dry_run,
-        )
-        # Copy artifacts back to the running host
-        with tempfile.NamedTemporaryFile(mode="w+t") as tmp:
+            check_call_cmd(
+                ["rsync", *rsync_rsh, ".config", f"{args.build_host}:.virtme/.config"],
+                quiet=not args.verbose,
+                dry_run=args.dry_run,
+            )
+            # Execute the remote build script, passing it to bash via stdin (no
+            # need to create a local temporary file and copy it to the build
+            # host, and it works regardless of the remote user's login shell)
+            script = REMOTE_BUILD_SCRIPT.format(
+                args.build_host_exec_prefix or "",
+                make_command + " -j$(nproc --all)",
+            )
+            remote_cmd = ["bash", "-s"]
+            # Allow to disable ccache also on the build host
+            if "CCACHE_DISABLE" in os.environ:
+                remote_cmd = ["env", "CCACHE_DISABLE=" + shlex.quote(os.environ["CCACHE_DISABLE"])] + remote_cmd
+            check_call_cmd(
+                ["ssh", *ssh_opts, args.build_host, *remote_cmd],
+                quiet=not args.verbose,
+                dry_run=args.dry_run,
+                stdin_data=script,
+            )
+            # Copy artifacts back to the running host
             if args.build_host_vmlinux or args.arch == "ppc64el":
                 vmlinux = "--include=vmlinux"
             else:
                 vmlinux = ""
             if args.skip_modules:
                 cmd = (
-                    "rsync -azS --progress --exclude=.config --exclude=.git/ "
+                    f"rsync -azS --progress {shlex.join(rsync_rsh)} --exclude=.config --exclude=.git/ "
                     + "--include=*/ --include=bzImage --include=zImage --include=Image "
                     + f'{vmlinux} --include=*.dtb --exclude="*" {args.build_host}:.virtme/ ./'
                 )
             else:
                 cmd = (
-                    "rsync -azS --progress --exclude=.config --exclude=.git/ "
+                    f"rsync -azS --progress {shlex.join(rsync_rsh)} --exclude=.config --exclude=.git/ "
                     + '--include=*/ --include="*.ko" --include=".dwo" '
                     + f"--include=bzImage --include=zImage --include=Image {vmlinux} "
                     + "--include=.config --include=modules.* "
@@ -800,10 +972,10 @@ class KernelSource:
                     + '--include=*.dtb --include="**/generated/**" --exclude="*" '
                     + f"{args.build_host}:.virtme/ ./"
                 )
-            tmp.write(cmd)
-            tmp.flush()
+            # Let bash expand the quoted rsync filters directly, no need to go
+            # through a temporary script file
             check_call_cmd(
-                ["bash", tmp.name], quiet=not args.verbose, dry_run=args.dry_run
+                ["bash", "-c", cmd], quiet=not args.verbose, dry_run=args.dry_run
             )
         if not args.skip_modules:
             if os.path.exists("./debian/rules"):
@@ -816,6 +988,7 @@ class KernelSource:
                 ),
                 quiet=not args.verbose,
                 dry_run=args.dry_run,
+                env=get_build_env(),
             )
 
     def make(self, args):
@@ -852,6 +1025,10 @@ class KernelSource:
             make_command += f" {target}"
         if cross_compile and cross_arch:
             make_command += f" CROSS_COMPILE={cross_compile} ARCH={cross_arch}"
+        # In quiet mode the build stdout is discarded anyway, so ask make to
+        # not generate it at all (warnings and errors go to stderr)
+        if not args.verbose:
+            make_command += " -s"
         # Propagate additional Makefile variables
         for var in args.envs:
             make_command += f" {var} "
@@ -861,6 +1038,7 @@ class KernelSource:
                 self._format_cmd(make_command + " -j" + self.cpus),
                 quiet=not args.verbose,
                 dry_run=args.dry_run,
+                env=get_build_env(),
             )
         else:
             # Build the kernel on a remote build host
@@ -956,6 +1134,11 @@ class KernelSource:
             # and run the corresponding kernel from the Ubuntu mainline
             # repository.
             if re.match(r'^v\d+(\.\d+)*(-rc\d+)?$', args.run):
+                # Import the mainline downloader only when needed, it pulls
+                # in the requests module, which is slow to import.
+                # pylint: disable=import-outside-toplevel
+                from virtme_ng.mainline import KernelDownloader
+
                 if args.arch is None:
                     arch = get_host_arch()
                 else:
@@ -1251,51 +1434,9 @@ class KernelSource:
         self._get_virtme_qemu_opts(args)
         self._get_virtme_nvgpu(args)
 
-        # Start VM using virtme-run
-        cmd = (
-            "virtme-run "
-            + f'{self.virtme_param["name"]} '
-            + f'{self.virtme_param["exec"]} '
-            + f'{self.virtme_param["user"]} '
-            + f'{self.virtme_param["arch"]} '
-            + f'{self.virtme_param["root"]} '
-            + f'{self.virtme_param["rw"]} '
-            + f'{self.virtme_param["rodir"]} '
-            + f'{self.virtme_param["rwdir"]} '
-            + f'{self.virtme_param["overlay_rwdir"]} '
-            + f'{self.virtme_param["cwd"]} '
-            + f'{self.virtme_param["kdir"]} '
-            + f'{self.virtme_param["dry_run"]} '
-            + f'{self.virtme_param["no_virtme_ng_init"]} '
-            + f'{self.virtme_param["mods"]} '
-            + f'{self.virtme_param["network"]} '
-            + f'{self.virtme_param["net_mac_address"]} '
-            + f'{self.virtme_param["console"]} '
-            + f'{self.virtme_param["console_client"]} '
-            + f'{self.virtme_param["ssh"]} '
-            + f'{self.virtme_param["ssh_client"]} '
-            + f'{self.virtme_param["remote_cmd"]} '
-            + f'{self.virtme_param["disk"]} '
-            + f'{self.virtme_param["sound"]} '
-            + f'{self.virtme_param["disable_microvm"]} '
-            + f'{self.virtme_param["disable_kvm"]} '
-            + f'{self.virtme_param["force_9p"]} '
-            + f'{self.virtme_param["force_initramfs"]} '
-            + f'{self.virtme_param["graphics"]} '
-            + f'{self.virtme_param["verbose"]} '
-            + f'{self.virtme_param["append"]} '
-            + f'{self.virtme_param["cpus"]} '
-            + f'{self.virtme_param["memory"]} '
-            + f'{self.virtme_param["numa"]} '
-            + f'{self.virtme_param["numa_distance"]} '
-            + f'{self.virtme_param["balloon"]} '
-            + f'{self.virtme_param["gdb"]} '
-            + f'{self.virtme_param["snaps"]} '
-            + f'{self.virtme_param["busybox"]} '
-            + f'{self.virtme_param["qemu"]} '
-            + f'{self.virtme_param["qemu_opts"]} '
-            + f'{self.virtme_param["nvgpu"]} '
-        )
+        # Start VM using virtme-run (parameters are passed in the same order
+        # they have been generated above)
+        cmd = "virtme-run " + " ".join(self.virtme_param.values())
         check_call(cmd, shell=True)
 
     def dump(self, args):
@@ -1391,8 +1532,9 @@ def dump(kern_source, args):
 
 def do_it() -> int:
     """Main body."""
-    argcomplete.autocomplete(_ARGPARSER)
-    args = _ARGPARSER.parse_args()
+    parser = _get_parser()
+    argcomplete.autocomplete(parser)
+    args = parser.parse_args()
 
     kern_source = KernelSource()
     if kern_source.default_opts: